@@ -18,21 +18,65 @@ Inspired by
 """
 import collections
 import datetime
+import errno
 import hashlib
+import mmap
 import os
 import re
 import shutil
 import sys
 import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
+import dateutil.parser
+import dateutil.tz
 import exifread
+import ffmpeg
 import glob
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    from mutagen import MutagenError
+    from mutagen.mp4 import MP4
+except ImportError:
+    MP4 = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 import socket # gethostname
 import logging
 
 logging.basicConfig(format='[%(asctime)s] %(levelname)s %(message)s', datefmt='%Y%m%d %H:%M:%S')
 
+LOCAL_TZ = dateutil.tz.tzlocal()
+HASH_CHUNK_SIZE = 1 << 18  # 256 KiB, same as hashlib.file_digest
+MMAP_MIN_SIZE = 1 << 18  # smaller files aren't worth the mmap setup
+
+def _sha1():
+    """
+    SHA-1 hasher for content fingerprints. Not used for security, so
+    skip the FIPS policy checks where Python supports it (3.9+).
+
+    """
+    try:
+        return hashlib.sha1(usedforsecurity=False)
+    except TypeError:
+        return hashlib.sha1()
+
+
 class HashCache(object):
     """
     Gives a quick answer to the question if there's an identical file
@@ -40,63 +84,127 @@ class HashCache(object):
 
     """
     def __init__(self):
-        # folder -> (hashes, filename -> hash)
-        self.hashes = collections.defaultdict(lambda: (set(), dict()))
+        # folder -> filename -> ((size, mtime), hash)
+        self.hashes = collections.defaultdict(dict)
+        # folder -> (mtime, [(path, (size, mtime))] of files in folder)
+        self.listings = dict()
 
     def has_file(self, target_folder, path):
         # Strip trailing slashes etc.
         target_folder = os.path.normpath(target_folder)
 
-        # Update the cache by ensuring that we have the hashes of all
-        # files in the target folder. `_add_file` is smart enough to
-        # skip any files we already hashed.
-        for f in self._files_in_folder(target_folder):
-            self._add_file(f)
-
-        # Hash the new file at `path`.
-        file_hash = self._hash(path)
+        # Files of different sizes can't be identical, so only the
+        # files in the target folder with the same size need hashing.
+        size = os.path.getsize(path)
+        candidates = [
+            (f, stat_key) for f, stat_key in self._files_in_folder(target_folder)
+            if stat_key[0] == size
+        ]
+        if not candidates:
+            return False
+
+        # Skip any candidates we already hashed with the same size and
+        # mtime; anything else is new or was modified since.
+        hashed = self.hashes[target_folder]
+        uncached = [
+            (f, stat_key) for f, stat_key in candidates
+            if hashed.get(os.path.basename(f), (None,))[0] != stat_key
+        ]
+        paths = [f for f, _ in uncached]
+
+        # Hash the new file at `path` together with the uncached ones.
+        # hashlib releases the GIL, so threads scale until the disk
+        # saturates. A single file (the warm-cache case) is hashed
+        # inline. The cache is only updated from this thread.
+        if paths:
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+                digests = list(ex.map(self._hash, paths + [path]))
+        else:
+            digests = [self._hash(path)]
+        file_hash = digests.pop()
+
+        for (f, stat_key), digest in zip(uncached, digests):
+            hashed[os.path.basename(f)] = (stat_key, digest)
 
         # Check if we already have an identical file in the target folder.
-        return file_hash in self.hashes[target_folder][0]
-
-    def _add_file(self, path):
-        # Bail out if we already have a hash for the file at `path`.
-        folder = self._target_folder(path)
-        if path in self.hashes[folder][1]:
-            return
-
-        file_hash = self._hash(path)
-
-        basename = os.path.basename(path)
-        self.hashes[folder][0].add(file_hash)
-        self.hashes[folder][1][basename] = file_hash
+        return any(
+            hashed[os.path.basename(f)][1] == file_hash for f, _ in candidates
+        )
 
     @staticmethod
     def _hash(path):
-        hasher = hashlib.sha1()
-        with open(path, 'rb') as f:
-            data = f.read()
-            hasher.update(data)
+        # The hash is only used as a content fingerprint to spot
+        # duplicates, so prefer the fastest available algorithm.
+        if blake3 is not None:
+            hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
+            hasher.update_mmap(path)
+            return hasher.hexdigest()
+
+        with open(path, 'rb', buffering=0) as f:
+            if xxhash is not None:
+                hasher = xxhash.xxh3_128()
+            else:
+                hasher = _sha1()
+
+            # Hash large files straight from the page cache, which saves
+            # copying every byte into a Python buffer first.
+            if os.fstat(f.fileno()).st_size > MMAP_MIN_SIZE:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, 'madvise'):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    hasher.update(mm)
+                return hasher.hexdigest()
+
+            if xxhash is None and hasattr(hashlib, 'file_digest'):
+                return hashlib.file_digest(f, _sha1).hexdigest()
+
+            # Stream in fixed-size chunks instead of reading the whole
+            # file into memory.
+            buf = bytearray(HASH_CHUNK_SIZE)
+            view = memoryview(buf)
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                hasher.update(view[:n])
         return hasher.hexdigest()
 
     @staticmethod
-    def _target_folder(path):
-        return os.path.dirname(path)
+    def _stat_key(st):
+        return (st.st_size, st.st_mtime_ns)
 
-    @staticmethod
-    def _files_in_folder(folder_path):
+    def _files_in_folder(self, folder_path):
         """
-        Iterable with full paths to all files in `folder_path`.
+        Iterable with (full path, (size, mtime)) of all files in
+        `folder_path`.
+
+        The listing is cached and only refreshed when the folder's
+        mtime changes, i.e. when entries were added or removed. A file
+        edited in place doesn't touch the folder's mtime, so its size
+        and mtime stay stale until the next refresh.
 
         """
         try:
-            names = (
-                os.path.join(folder_path, f) for f in os.listdir(folder_path)
-            )
-            return [f for f in names if os.path.isfile(f)]
+            mtime = os.stat(folder_path).st_mtime_ns
+        except OSError:
+            return []
+
+        cached = self.listings.get(folder_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        try:
+            with os.scandir(folder_path) as it:
+                files = [
+                    (e.path, self._stat_key(e.stat()))
+                    for e in it if e.is_file()
+                ]
         except OSError:
             return []
 
+        self.listings[folder_path] = (mtime, files)
+        return files
+
 
 hash_cache = HashCache()
 
@@ -117,22 +225,32 @@ def move_file(root_folder, path):
     #    print('%s is a duplicate, skipping' % path)
     #    return
 
-    try:
-        os.makedirs(dirs)
+    if not os.path.isdir(dirs):
+        os.makedirs(dirs, exist_ok=True)
         print('Created folder %s' % dirs)
-    except OSError as e:
-        # Catch "File exists"
-        if e.errno != 17:
-            raise e
 
     if dst.find("2012-02-28") > 0:
         print("Skip %s %s (shoot on 2012-02-28)" % (path, dst))
     else:
         print('Moving %s to %s' % (path, dst))
-        shutil.move(path, dst)
+        rename_or_move(path, dst)
         aaefile = path[:-3] + "AAE"
         if os.path.isfile(aaefile):
-            shutil.move(aaefile, dst + ".AAE")
+            rename_or_move(aaefile, dst + ".AAE")
+
+
+def rename_or_move(src, dst):
+    """
+    A single rename syscall in the common same-filesystem case; fall
+    back to shutil.move's copy + delete across filesystems.
+
+    """
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
 
 
 def resolve_duplicate(path):
@@ -155,9 +273,14 @@ def resolve_duplicate(path):
     return new_path
 
 
+VALID_EXTS = frozenset([
+    '.jpg', '.jpeg', '.png', '.dng', '.crw', '.pef', ".tif", ".heic", ".mov", ".mp4"
+])
+
+
 def is_valid_filename(path):
     ext = os.path.splitext(path)[1].lower()
-    return ext in ['.jpg', '.jpeg', '.png', '.dng', '.crw', '.pef', ".tif", ".heic", ".mov", ".mp4"]
+    return ext in VALID_EXTS
 
 
 def dest_path(root_folder, path):
@@ -173,14 +296,25 @@ def path_from_datetime(root_folder, dt, path):
     return os.path.join(root_folder, folder, filename)
 
 
+FOLDER_FORMAT = '%Y' + os.sep + '%Y-%m'
+
+
 def folder_from_datetime(dt):
-    return dt.strftime('%Y' + os.sep + '%Y-%m')
+    return dt.strftime(FOLDER_FORMAT)
+
+
+_NON_ALNUM = re.compile("[^A-Za-z0-9]")
+_NON_DIGIT = re.compile("[^0-9]")
+_14DIGIT = re.compile(r"20[0-9]{12}")
 
 
 def filename_has_14digit(basename):
-    bb = re.sub("[^A-Za-z0-9]", "", basename)
-    bb0 = re.sub("[^0-9]", "", basename)
-    if bb0.startswith("20") and re.search(r"20[0-9]{12}", bb):
+    bb = _NON_ALNUM.sub("", basename)
+    if not _14DIGIT.search(bb):
+        return None
+    # `bb` keeps every digit of `basename`, so strip the letters from it.
+    bb0 = _NON_DIGIT.sub("", bb)
+    if bb0.startswith("20"):
         return bb
     # logging.warning(f"{bb} no 14 digits")
     return None
@@ -235,32 +369,64 @@ def file_creation_date(path):
     mtime = os.path.getmtime(path)
     return datetime.datetime.fromtimestamp(mtime)
 
+def mp4_tag_creation_time(path):
+    """
+    Reads the '\xa9day' tag with mutagen, which only walks the MP4/MOV
+    atoms instead of spawning ffprobe. Returns None if mutagen is not
+    installed or the file has no full date in that tag.
+
+    """
+    if MP4 is None:
+        return None
+
+    try:
+        tags = MP4(path).tags
+    except MutagenError:
+        return None
+
+    values = tags.get('\xa9day') if tags else None
+    # Skip year-only values like '2017'.
+    if values and len(values[0]) >= len('YYYY-MM-DDTHH:MM:SS'):
+        return values[0]
+    return None
+
 def mov_creation_date(path):
-    import ffmpeg
+    dtstr = mp4_tag_creation_time(path)
+    if dtstr:
+        return video_creation_date(dtstr, path)
 
-    dtstr = None
     try:
         for info in ffmpeg.probe(path)["streams"]:
             dtstr = info["tags"].get("creation_time", None)
             if dtstr: break
-    except:
+    except (ffmpeg.Error, KeyError) as e:
         # return None
-        logging.error(f"invalid date {path}")
+        logging.error(f"invalid date {path}: {e!r}")
         raise
 
-    from dateutil import parser, tz
-    ts = parser.parse(dtstr).astimezone(tz.tzlocal())
-    if int(ts.strftime("%Y%m%d")) <= 2001:
-        logging.warning(f"{ts} is too old, invalid. {path}")
-        return None
-    return ts
+    return video_creation_date(dtstr, path)
 
 def mp4_creation_date(path):
-    import ffmpeg
-    info = ffmpeg.probe(path)["streams"][0]
-    dtstr = info["tags"]["creation_time"]
-    from dateutil import parser, tz
-    ts = parser.parse(dtstr).astimezone(tz.tzlocal())
+    dtstr = mp4_tag_creation_time(path)
+    if not dtstr:
+        info = ffmpeg.probe(path)["streams"][0]
+        dtstr = info["tags"]["creation_time"]
+    return video_creation_date(dtstr, path)
+
+# ffprobe reports '2017-11-11T11:11:11.000000Z', MP4 tags usually omit
+# the fraction.
+VIDEO_TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z')
+
+def parse_video_timestamp(dtstr):
+    for fmt in VIDEO_TIMESTAMP_FORMATS:
+        try:
+            return datetime.datetime.strptime(dtstr, fmt)
+        except ValueError:
+            pass
+    return dateutil.parser.parse(dtstr)
+
+def video_creation_date(dtstr, path):
+    ts = parse_video_timestamp(dtstr).astimezone(LOCAL_TZ)
     if int(ts.strftime("%Y%m%d")) <= 2001:
         logging.warning(f"{ts} is too old, invalid. {path}")
         return None
@@ -275,7 +441,7 @@ def exif_creation_date(path):
 
     try:
         return exif_timestamp_to_datetime(ts)
-    except BadExifTimestampError:
+    except BadExifTimestampError as e:
         print(e)
         return None
 
@@ -288,9 +454,35 @@ class MissingExifTimestampError(Exception):
     pass
 
 
+# EXIF SubIFD pointer and the timestamp tags stored in it.
+EXIF_IFD_POINTER = 0x8769
+EXIF_DATETIME_ORIGINAL = 36867
+EXIF_DATETIME_DIGITIZED = 36868
+
+
+# Pillow's getexif() decodes the whole image for these; exifread only
+# walks the chunks.
+PILLOW_EXIF_LOADS_PIXELS = frozenset(['.png'])
+
+
 def exif_creation_timestamp(path):
+    ext = os.path.splitext(path)[1].lower()
+    if Image is not None and ext not in PILLOW_EXIF_LOADS_PIXELS:
+        try:
+            return pillow_exif_creation_timestamp(path)
+        except (OSError, Image.DecompressionBombError):
+            # Format Pillow can't open (raw files, HEIC without a
+            # plugin, ...) or a header above ~179 MP; let exifread
+            # have a go.
+            pass
+
     with open(path, 'rb') as f:
-        tags = exifread.process_file(f, details=False)
+        # Stop once DateTimeOriginal is read instead of walking the
+        # remaining IFDs, thumbnail and MakerNote. If it is missing the
+        # whole EXIF IFD is parsed, which picks up DateTimeDigitized.
+        tags = exifread.process_file(
+            f, details=False, stop_tag='DateTimeOriginal'
+        )
 
     if 'EXIF DateTimeOriginal' in tags:
         return str(tags['EXIF DateTimeOriginal'])
@@ -300,13 +492,44 @@ def exif_creation_timestamp(path):
     raise MissingExifTimestampError()
 
 
-def exif_timestamp_to_datetime(ts):
-    elements = [int(_) for _ in re.split(':| ', ts)]
+def pillow_exif_creation_timestamp(path):
+    """
+    Reads the timestamp with Pillow. For JPEG and TIFF this only parses
+    the EXIF segment and never decodes pixel data since we don't call
+    `load()`; PNG's getexif() loads the image, so PNGs go to exifread.
+
+    """
+    # Nothing is decoded, so silence the warning Pillow emits above
+    # ~89 MP. Larger headers raise DecompressionBombError instead.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+        with Image.open(path) as img:
+            exif = img.getexif().get_ifd(EXIF_IFD_POINTER)
+
+    ts = exif.get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME_DIGITIZED)
+    if ts:
+        return str(ts).strip('\x00 ')
 
-    if len(elements) != 6:
-        raise BadExifTimestampError
+    raise MissingExifTimestampError()
+
+
+def exif_timestamp_to_datetime(ts):
+    # EXIF timestamps are normally fixed width: 'YYYY:MM:DD HH:MM:SS'.
+    if len(ts) == 19 and ts[4] == ':' and ts[7] == ':' and ts[10] == ' ' \
+            and ts[13] == ':' and ts[16] == ':':
+        try:
+            return datetime.datetime(
+                int(ts[0:4]), int(ts[5:7]), int(ts[8:10]),
+                int(ts[11:13]), int(ts[14:16]), int(ts[17:19]),
+            )
+        except ValueError:
+            pass
 
-    return datetime.datetime(*elements)
+    # Some cameras don't zero-pad, e.g. '2009:10:25 9:54:11'.
+    try:
+        return datetime.datetime.strptime(ts, '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        raise BadExifTimestampError(ts)
 
 
 def _files_in_folder(folder_path):
@@ -322,11 +545,28 @@ def _files_in_folder(folder_path):
         return []
 
 def run_dirs(dest_folder, src_folder):
-    for root, dirs, files in os.walk(src_folder):
-        for f in files:
-            if root.find("@eaDir") >= 0: continue
-            #print(f)
-            move_file(dest_folder, os.path.join(root, f))
+    if src_folder.find("@eaDir") >= 0: return
+
+    stack = [src_folder]
+    while stack:
+        root = stack.pop()
+        try:
+            with os.scandir(root) as it:
+                entries = list(it)
+        except OSError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir():
+                # Prune Synology thumbnail folders before descending.
+                if entry.name.find("@eaDir") >= 0: continue
+                if not entry.is_symlink(): subdirs.append(entry.path)
+            else:
+                #print(entry.name)
+                move_file(dest_folder, entry.path)
+        # Keep os.walk's top-down order.
+        stack.extend(reversed(subdirs))
     
 if __name__ == '__main__':
     #for root, dirs, files in os.walk("2011-09"):